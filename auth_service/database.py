@@ -1,5 +1,7 @@
 import os
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import pool
 from psycopg2.extras import RealDictCursor
 
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -7,43 +9,100 @@ DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 DB_NAME = os.getenv("DB_NAME", "learning_platform")
 
-def get_db_connection():
-    """Create database connection"""
-    return psycopg2.connect(
+# Hot statements, prepared once per pooled connection so Postgres skips
+# parse+plan on every request. Endpoints run EXECUTE <name>(...) instead
+# of re-sending the SQL text.
+PREPARED_STATEMENTS = {
+    "auth_register": """
+        INSERT INTO users (username, email, password_hash)
+        VALUES ($1, $2, $3)
+        ON CONFLICT DO NOTHING
+        RETURNING id, username, email
+    """,
+    "auth_login": """
+        SELECT id, username, email, password_hash, is_active
+        FROM users WHERE email = $1
+    """,
+    "auth_me": """
+        SELECT id, username, email, created_at, is_active
+        FROM users WHERE id = $1
+    """,
+}
+
+class PreparedConnectionPool(pool.ThreadedConnectionPool):
+    """Connection pool that prepares the hot statements on every new connection"""
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        with conn.cursor() as cursor:
+            for name, sql in PREPARED_STATEMENTS.items():
+                cursor.execute(f"PREPARE {name} AS {sql}")
+        conn.commit()
+        return conn
+
+# Connection pool - created lazily so import doesn't fail when the DB is
+# down, and so init_db has created the tables the PREPAREs reference
+_POOL = None
+
+def _get_pool():
+    global _POOL
+    if _POOL is None:
+        _POOL = PreparedConnectionPool(
+            minconn=2,
+            maxconn=20,
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME,
+            cursor_factory=RealDictCursor
+        )
+    return _POOL
+
+@contextmanager
+def connection():
+    """Borrow a pooled database connection"""
+    conn = _get_pool().getconn()
+    try:
+        yield conn
+    finally:
+        _get_pool().putconn(conn)
+
+def init_db():
+    """Initialize database with users table"""
+    # Direct connection: the pool's PREPAREs reference the users table, so
+    # the schema has to exist before the first pooled connection is made
+    conn = psycopg2.connect(
         host=DB_HOST,
         user=DB_USER,
         password=DB_PASSWORD,
-        database=DB_NAME,
-        cursor_factory=RealDictCursor
+        database=DB_NAME
     )
+    try:
+        cursor = conn.cursor()
 
-def init_db():
-    """Initialize database with users table"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create users table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            username VARCHAR(50) UNIQUE NOT NULL,
-            email VARCHAR(100) UNIQUE NOT NULL,
-            password_hash VARCHAR(255) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_login TIMESTAMP,
-            is_active BOOLEAN DEFAULT true
-        )
-    """)
-    
-    # Create indexes
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)
-    """)
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)
-    """)
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
+        # Create users table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                username VARCHAR(50) UNIQUE NOT NULL,
+                email VARCHAR(100) UNIQUE NOT NULL,
+                password_hash VARCHAR(255) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_login TIMESTAMP,
+                is_active BOOLEAN DEFAULT true
+            )
+        """)
+
+        # Create indexes
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)
+        """)
+
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
     print("✓ Database initialized")
@@ -1,17 +1,42 @@
 import os
+import time
+import sys
+import asyncio
 import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from psycopg2.extras import execute_values
 from typing import Optional
 
-from database import get_db_connection, init_db
+sys.path.append("..")
+from common.kafka_consumer import create_consumer
+from common.kafka_producer import send_event, KAFKA_AVAILABLE
+
+from database import connection, init_db
 from schemas import UserRegister, UserLogin, Token, UserResponse
-from auth import hash_password, verify_password, create_access_token, decode_token
+from auth import hash_password, verify_password, create_access_token, decode_token, BCRYPT_ROUNDS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("auth_service")
 
+# bcrypt is compute-bound (~100ms+ per call) - run it in worker processes
+# so the event loop stays responsive under concurrent logins
+BCRYPT_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Verified against when a login targets a non-existent user, so missing
+# accounts cost the same bcrypt time as real ones (no enumeration oracle).
+# Computed once at import instead of per request. Timing it doubles as a
+# calibration sample so operators can tune BCRYPT_ROUNDS per hardware.
+_hash_start = time.perf_counter()
+DUMMY_HASH = hash_password("x" * 16)
+logger.info(
+    f"bcrypt cost={BCRYPT_ROUNDS}: one hash took "
+    f"{(time.perf_counter() - _hash_start) * 1000:.0f}ms"
+)
+
 app = FastAPI(title="Auth Service", version="1.0.0")
 
 #  CORS
@@ -23,6 +48,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def last_login_consumer():
+    """
+    Background worker: batches deferred last_login events into a single
+    UPDATE statement instead of one round-trip per login
+    """
+    try:
+        consumer = create_consumer("auth.last_login", "auth_service_group")
+        logger.info("Kafka consumer started: listening for last_login events")
+
+        while True:
+            batch = consumer.poll(timeout_ms=1000, max_records=100)
+            updates = {}
+            for messages in batch.values():
+                for message in messages:
+                    data = message.value
+                    updates[data["user_id"]] = data["ts"]
+
+            if not updates:
+                continue
+
+            try:
+                with connection() as conn:
+                    cursor = conn.cursor()
+                    execute_values(cursor, """
+                        UPDATE users SET last_login = v.ts::timestamp
+                        FROM (VALUES %s) AS v(id, ts)
+                        WHERE users.id = v.id
+                    """, list(updates.items()))
+                    conn.commit()
+                    cursor.close()
+            except Exception as e:
+                logger.error(f"last_login batch update failed: {e}")
+    except Exception as e:
+        logger.error(f"Kafka consumer error: {e}")
+
 # Initialize database on startup
 @app.on_event("startup")
 async def startup():
@@ -32,6 +92,8 @@ async def startup():
     except Exception as e:
         logger.error(f"Database initialization failed: {e}")
         logger.warning("Service started but database may not be ready")
+    if KAFKA_AVAILABLE:
+        threading.Thread(target=last_login_consumer, daemon=True).start()
 
 @app.get("/")
 async def root():
@@ -40,110 +102,124 @@ async def root():
 @app.post("/api/auth/register", response_model=Token)
 async def register(user: UserRegister):
     """Register a new user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Check if user already exists
-        cursor.execute("SELECT id FROM users WHERE email = %s OR username = %s", 
-                      (user.email, user.username))
-        if cursor.fetchone():
+        # Hash password (off the event loop - bcrypt blocks for ~100ms+).
+        # Done before borrowing a connection so the pool isn't held for
+        # the whole hash under a burst of registrations.
+        loop = asyncio.get_running_loop()
+        password_hash = await loop.run_in_executor(BCRYPT_POOL, hash_password, user.password)
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            try:
+                # Create user - ON CONFLICT covers both unique constraints
+                # (email, username) in one round-trip without a TOCTOU race.
+                # Statement is prepared per-connection in database.py.
+                cursor.execute("EXECUTE auth_register (%s, %s, %s)",
+                              (user.username, user.email, password_hash))
+
+                new_user = cursor.fetchone()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+        if not new_user:
             raise HTTPException(status_code=400, detail="User already exists")
-        
-        # Hash password
-        password_hash = hash_password(user.password)
-        
-        # Create user
-        cursor.execute("""
-            INSERT INTO users (username, email, password_hash)
-            VALUES (%s, %s, %s)
-            RETURNING id, username, email
-        """, (user.username, user.email, password_hash))
-        
-        new_user = cursor.fetchone()
-        conn.commit()
-        
+
         # Create JWT token
         token = create_access_token({
             "user_id": new_user["id"],
             "username": new_user["username"],
             "email": new_user["email"]
         })
-        
+
         logger.info(f"New user registered: {user.username}")
-        
+
         return Token(
             token=token,
             user_id=new_user["id"],
             username=new_user["username"],
             email=new_user["email"]
         )
-        
+
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         logger.error(f"Registration error: {e}")
         raise HTTPException(status_code=500, detail="Registration failed")
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.post("/api/auth/login", response_model=Token)
 async def login(credentials: UserLogin):
     """Login user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Get user
-        cursor.execute("""
-            SELECT id, username, email, password_hash, is_active
-            FROM users WHERE email = %s
-        """, (credentials.email,))
-        
-        user = cursor.fetchone()
-        
-        if not user:
+        # Get user in a short-lived connection (statement prepared
+        # per-connection in database.py) - the connection goes back to
+        # the pool before the ~100ms bcrypt check, so a burst of logins
+        # queues on the bcrypt pool instead of exhausting maxconn
+        with connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("EXECUTE auth_login (%s)", (credentials.email,))
+                user = cursor.fetchone()
+            finally:
+                cursor.close()
+
+        # Verify password (off the event loop - bcrypt blocks for ~100ms+).
+        # Verify against the dummy hash when the user is missing so the
+        # 401 takes the same time either way.
+        password_hash = user["password_hash"] if user else DUMMY_HASH
+        loop = asyncio.get_running_loop()
+        password_ok = await loop.run_in_executor(
+            BCRYPT_POOL, verify_password, credentials.password, password_hash
+        )
+        if not user or not password_ok:
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        
+
         if not user["is_active"]:
             raise HTTPException(status_code=403, detail="Account disabled")
-        
-        # Verify password
-        if not verify_password(credentials.password, user["password_hash"]):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        
-        # Update last login
-        cursor.execute("""
-            UPDATE users SET last_login = %s WHERE id = %s
-        """, (datetime.utcnow(), user["id"]))
-        conn.commit()
-        
+
+        # Defer the last_login write - the background consumer batches
+        # these into one UPDATE instead of paying a round-trip per login
+        if KAFKA_AVAILABLE:
+            send_event("auth.last_login", {
+                "user_id": user["id"],
+                "ts": datetime.utcnow().isoformat()
+            })
+        else:
+            with connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("""
+                        UPDATE users SET last_login = %s WHERE id = %s
+                    """, (datetime.utcnow(), user["id"]))
+                    conn.commit()
+                finally:
+                    cursor.close()
+
         # Create JWT token
         token = create_access_token({
             "user_id": user["id"],
             "username": user["username"],
             "email": user["email"]
         })
-        
+
         logger.info(f"User logged in: {user['username']}")
-        
+
         return Token(
             token=token,
             user_id=user["id"],
             username=user["username"],
             email=user["email"]
         )
-        
+
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Login error: {e}")
         raise HTTPException(status_code=500, detail="Login failed")
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.get("/api/auth/me", response_model=UserResponse)
 async def get_current_user(authorization: Optional[str] = Header(None)):
@@ -152,24 +228,22 @@ async def get_current_user(authorization: Optional[str] = Header(None)):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     try:
-        token = authorization.replace("Bearer ", "")
+        if not authorization.startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="Invalid token")
+        token = authorization[7:]
         payload = decode_token(token)
         
         if not payload:
             raise HTTPException(status_code=401, detail="Invalid token")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, username, email, created_at, is_active
-            FROM users WHERE id = %s
-        """, (payload["user_id"],))
-        
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            # Statement prepared per-connection in database.py
+            cursor.execute("EXECUTE auth_me (%s)", (payload["user_id"],))
+
+            user = cursor.fetchone()
+            cursor.close()
+
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -1,19 +1,26 @@
 import os
+import time
 import json
-import threading
+import asyncio
+import orjson
+import asyncpg
 import boto3
-import psycopg2
+from botocore.config import Config as BotoConfig
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import google.generativeai as genai
+from cachetools import TTLCache
 import sys
 
+from aiokafka import AIOKafkaConsumer
+
 sys.path.append("..")
-from common.kafka_consumer import create_consumer
-from common.kafka_producer import send_event
+from common.config import KAFKA_BOOTSTRAP_SERVERS
+from common.kafka_producer import send_event, close as close_kafka_producer
 
 load_dotenv()
 
@@ -28,15 +35,33 @@ DB_PASS = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# System prompt for educational context - part of the model config, so it
+# is compiled once and never rebuilt or re-sent per request
+SYSTEM_PROMPT = """You are an intelligent educational assistant for a cloud-based learning platform.
+Your role is to help students learn by:
+- Explaining complex topics in simple terms
+- Providing examples and analogies
+- Encouraging critical thinking
+- Being patient and supportive
+- Staying focused on educational topics
+
+Keep responses concise and engaging."""
+
 # Initialize Gemini AI
 if GEMINI_API_KEY and GEMINI_API_KEY != "your_gemini_api_key_here":
     genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.0-flash')
+    model = genai.GenerativeModel('gemini-2.0-flash', system_instruction=SYSTEM_PROMPT)
 else:
     model = None
     print("WARNING: GEMINI_API_KEY not configured. Chat will use placeholder responses.")
 
-s3_client = boto3.client('s3', region_name=AWS_REGION)
+# Keepalive plus a pool large enough for the archival worker threads,
+# so concurrent PUTs reuse TLS sessions instead of re-handshaking
+s3_client = boto3.client('s3', region_name=AWS_REGION, config=BotoConfig(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+))
 
 class ChatRequest(BaseModel):
     user_id: str
@@ -55,165 +80,306 @@ class ChatHistoryRequest(BaseModel):
     user_id: str
     limit: int = 20
 
-def get_db_connection():
+# asyncpg pool - DB I/O awaits on the event loop instead of blocking it,
+# so one worker can keep many SSE streams in flight. Created at startup;
+# stays None when the database is unreachable.
+PG_POOL = None
+
+@app.on_event("startup")
+async def initialize_database():
+    global PG_POOL
     try:
-        return psycopg2.connect(
-            host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS
+        PG_POOL = await asyncpg.create_pool(
+            host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS,
+            min_size=2, max_size=20
         )
-    except psycopg2.Error as e:
-        print(f"Database connection failed: {e}")
-        return None
+    except Exception as e:
+        print(f"Database pool creation failed: {e}")
+        return
 
-@app.on_event("startup")
-def initialize_database():
-    conn = get_db_connection()
-    if not conn:
+    async with PG_POOL.acquire() as conn:
+        # Enable UUID extension
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\";")
+
+        # Create conversations table
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+                user_id VARCHAR(100) NOT NULL,
+                title VARCHAR(255) DEFAULT 'New Conversation',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_archived BOOLEAN DEFAULT FALSE
+            );
+            CREATE INDEX IF NOT EXISTS idx_conv_user_id ON conversations(user_id);
+        """)
+
+        # Create or alter chat_history table
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id SERIAL PRIMARY KEY,
+                user_id VARCHAR(100),
+                message TEXT,
+                role VARCHAR(20),
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
+        # Add conversation_id column if it doesn't exist (migration for existing tables)
+        await conn.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name='chat_history' AND column_name='conversation_id'
+                ) THEN
+                    ALTER TABLE chat_history ADD COLUMN conversation_id UUID NULL;
+                    ALTER TABLE chat_history ADD CONSTRAINT fk_conversation
+                        FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE;
+                END IF;
+            END $$;
+        """)
+
+        # Create indexes - the composite (conversation_id, timestamp DESC)
+        # index serves the context query's ORDER BY ... LIMIT without a sort
+        # and replaces the old single-column idx_chat_conversation_id
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_conv_ts ON chat_history(conversation_id, timestamp DESC);")
+        await conn.execute("DROP INDEX IF EXISTS idx_chat_conversation_id;")
+        # Same shape for user-scoped history: (user_id, timestamp DESC)
+        # orders the scan so ORDER BY ... LIMIT needs no sort; the plain
+        # user_id index it replaces couldn't provide the ordering
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_user_ts ON chat_history(user_id, timestamp DESC);")
+        await conn.execute("DROP INDEX IF EXISTS idx_user_id;")
+
+# S3 archival runs on worker threads so it never blocks the SSE stream
+S3_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Pending chat_history rows, drained in batches by _message_writer
+MSG_QUEUE = None
+
+async def _flush_messages(batch):
+    """Write a batch of chat messages and touch their conversations in one round-trip"""
+    if PG_POOL is None:
         return
+    async with PG_POOL.acquire() as conn:
+        await conn.executemany(
+            "INSERT INTO chat_history (conversation_id, user_id, message, role, timestamp) VALUES ($1, $2, $3, $4, $5)",
+            batch
+        )
+        # One coalesced updated_at touch per flush instead of one per message
+        conversation_ids = list({row[0] for row in batch})
+        await conn.execute(
+            "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ANY($1::uuid[])",
+            conversation_ids
+        )
+
+# Upper bound on queued rows when flushes are failing - beyond this a
+# dead database drops batches (with a log line) instead of growing RSS
+MSG_QUEUE_LIMIT = 10000
+
+async def _write_batch(batch):
+    """Flush one batch; requeue it on failure so messages survive retries"""
     try:
-        with conn.cursor() as cur:
-            # Enable UUID extension
-            cur.execute("CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\";")
-            
-            # Create conversations table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-                    user_id VARCHAR(100) NOT NULL,
-                    title VARCHAR(255) DEFAULT 'New Conversation',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_archived BOOLEAN DEFAULT FALSE
-                );
-                CREATE INDEX IF NOT EXISTS idx_conv_user_id ON conversations(user_id);
-            """)
-            
-            # Create or alter chat_history table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id SERIAL PRIMARY KEY,
-                    user_id VARCHAR(100),
-                    message TEXT,
-                    role VARCHAR(20),
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            
-            # Add conversation_id column if it doesn't exist (migration for existing tables)
-            cur.execute("""
-                DO $$ 
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 FROM information_schema.columns 
-                        WHERE table_name='chat_history' AND column_name='conversation_id'
-                    ) THEN
-                        ALTER TABLE chat_history ADD COLUMN conversation_id UUID NULL;
-                        ALTER TABLE chat_history ADD CONSTRAINT fk_conversation 
-                            FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE;
-                        CREATE INDEX idx_chat_conversation_id ON chat_history(conversation_id);
-                    END IF;
-                END $$;
-            """)
-            
-            # Create indexes
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON chat_history(user_id);")
-            
-            conn.commit()
-    finally:
-        conn.close()
-    # Start Kafka consumer in background thread
-    threading.Thread(target=document_consumer, daemon=True).start()
+        await _flush_messages(batch)
+    except Exception as e:
+        if MSG_QUEUE.qsize() + len(batch) <= MSG_QUEUE_LIMIT:
+            for row in batch:
+                MSG_QUEUE.put_nowait(row)
+            print(f"Message batch write failed, requeued {len(batch)} messages: {e}")
+        else:
+            print(f"Message batch write failed, queue full - dropped {len(batch)} messages: {e}")
+        # Don't hot-loop against a dead database
+        await asyncio.sleep(1)
+        return
+    # One NDJSON object per user per batch instead of one PUT per message.
+    # Archived only after a successful flush so requeued batches don't
+    # land in S3 twice.
+    S3_EXECUTOR.submit(_archive_batch, batch)
 
-def save_message(conversation_id: str, user_id: str, message: str, role: str):
-    """Save message to database and S3"""
-    conn = get_db_connection()
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO chat_history (conversation_id, user_id, message, role) VALUES (%s, %s, %s, %s)",
-                    (conversation_id, user_id, message, role)
-                )
-                # Update conversation's updated_at timestamp
-                cur.execute(
-                    "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-                    (conversation_id,)
-                )
-            conn.commit()
-        finally:
-            conn.close()
-    
-    # Archive to S3
-    timestamp = datetime.now().isoformat()
-    s3_key = f"chats/{user_id}/{conversation_id}/{timestamp}_{role}.json"
+async def _message_writer():
+    """Drain MSG_QUEUE every 50ms, flushing accumulated messages as one batch"""
+    while True:
+        batch = [await MSG_QUEUE.get()]
+        await asyncio.sleep(0.05)
+        while not MSG_QUEUE.empty() and len(batch) < 100:
+            batch.append(MSG_QUEUE.get_nowait())
+        await _write_batch(batch)
+
+@app.on_event("shutdown")
+async def drain_message_queue():
+    """Write out anything still queued so restarts don't drop messages"""
+    if MSG_QUEUE is None or MSG_QUEUE.empty():
+        return
+    batch = []
+    while not MSG_QUEUE.empty():
+        batch.append(MSG_QUEUE.get_nowait())
     try:
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=s3_key,
-            Body=json.dumps({"conversation_id": conversation_id, "user_id": user_id, "message": message, "role": role, "timestamp": timestamp})
-        )
+        await _flush_messages(batch)
+        _archive_batch(batch)
     except Exception as e:
-        print(f"S3 Archival Error: {e}")
+        print(f"Shutdown drain failed, {len(batch)} messages lost: {e}")
+
+@app.on_event("shutdown")
+def flush_kafka_producer():
+    close_kafka_producer()
+
+@app.on_event("startup")
+async def start_message_writer():
+    global MSG_QUEUE
+    MSG_QUEUE = asyncio.Queue()
+    asyncio.create_task(_message_writer())
+
+def _archive_batch(batch):
+    """Archive a flushed batch to S3 as one NDJSON object per user"""
+    by_user = {}
+    for conversation_id, user_id, message, role, ts in batch:
+        by_user.setdefault(user_id, []).append({
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "message": message,
+            "role": role,
+            "timestamp": ts.isoformat()
+        })
+    for user_id, records in by_user.items():
+        s3_key = f"chats/{user_id}/{records[0]['timestamp']}.ndjson"
+        body = b"\n".join(orjson.dumps(record) for record in records)
+        try:
+            s3_client.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=body)
+        except Exception as e:
+            print(f"S3 Archival Error: {e}")
 
-def get_conversation_context(conversation_id: str, limit: int = 50):
-    """Retrieve recent conversation history for context"""
-    conn = get_db_connection()
-    if not conn:
+def save_message(conversation_id: str, user_id: str, message: str, role: str):
+    """Queue message for a batched database write and S3 archival"""
+    MSG_QUEUE.put_nowait((conversation_id, user_id, message, role, datetime.now()))
+
+    # Append to any cached context for this conversation so readers see the
+    # new message without waiting for the batch flush or re-querying
+    for key in list(CTX.keys()):
+        if key[0] == conversation_id:
+            context = CTX.get(key)
+            if context is not None:
+                context.append((role, message))
+                del context[:-key[1]]
+
+# Hot per-conversation context - steady-state chat turns read the same
+# recent rows over and over, so serve them from memory and keep the cache
+# current from the save path instead of re-querying
+CTX = TTLCache(maxsize=5000, ttl=300)
+
+async def get_conversation_context(conversation_id: str, limit: int = 50):
+    """Retrieve recent conversation history for context (cached)"""
+    cached = CTX.get((conversation_id, limit))
+    if cached is not None:
+        return cached
+    if PG_POOL is None:
         return []
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT role, message FROM chat_history WHERE conversation_id = %s ORDER BY timestamp DESC LIMIT %s",
-                (conversation_id, limit)
-            )
-            rows = cur.fetchall()
-    finally:
-        conn.close()
-    
-    # Reverse to get chronological order
-    return [{"role": row[0], "message": row[1]} for row in reversed(rows)]
+    rows = await PG_POOL.fetch(
+        "SELECT role, message FROM chat_history WHERE conversation_id = $1 ORDER BY timestamp DESC LIMIT $2",
+        conversation_id, limit
+    )
 
-async def generate_streaming_response(conversation_id: str, user_id: str, message: str):
-    """Generate streaming AI response using Gemini"""
-    # Get conversation context (last 50 messages from this conversation)
-    context = get_conversation_context(conversation_id)
-    
-    # Build conversation history for Gemini
-    chat_history = []
-    for msg in context:
-        if msg["role"] == "user":
-            chat_history.append({"role": "user", "parts": [msg["message"]]})
-        elif msg["role"] == "assistant":
-            chat_history.append({"role": "model", "parts": [msg["message"]]})
-    
-    # System prompt for educational context
-    system_prompt = """You are an intelligent educational assistant for a cloud-based learning platform. 
-Your role is to help students learn by:
-- Explaining complex topics in simple terms
-- Providing examples and analogies
-- Encouraging critical thinking
-- Being patient and supportive
-- Staying focused on educational topics
+    # Reverse to get chronological order; tuples are cheaper than dicts here
+    context = [(row[0], row[1]) for row in reversed(rows)]
+    CTX[(conversation_id, limit)] = context
+    return context
 
-Keep responses concise and engaging."""
-    
+# Maps stored roles onto Gemini's expected role names
+ROLE_MAP = {"user": "user", "assistant": "model"}
+
+# Live Gemini chat sessions, one per conversation. The session keeps the
+# transcript prefix byte-stable across turns (the system prompt lives in
+# the model config), so each turn only appends the new message instead of
+# rebuilding history from the DB - and the stable prefix lets provider-side
+# prompt caching hit. Sessions idle for 30 minutes are evicted.
+SESSIONS = TTLCache(maxsize=10000, ttl=1800)
+
+# Running token estimate per session, updated as turns complete, so the
+# budget check doesn't rescan the whole transcript every turn
+SESSION_TOKENS = TTLCache(maxsize=10000, ttl=1800)
+
+# Rough chars//4 token estimate; past this the transcript gets trimmed
+HISTORY_TOKEN_BUDGET = 32768
+
+def est_tokens(s: str) -> int:
+    return len(s) // 4
+
+def _trimmed_session(chat):
+    """Build a fresh session with the oldest turns collapsed into a short
+    summary and the recent tail kept verbatim"""
+    # Keep the newest turns that fit in half the budget
+    tail = []
+    used = 0
+    for content in reversed(chat.history):
+        size = sum(est_tokens(part.text) for part in content.parts)
+        if used + size > HISTORY_TOKEN_BUDGET // 2:
+            break
+        tail.append(content)
+        used += size
+    tail.reverse()
+    # Gemini requires strict user/model alternation starting with user
+    while tail and tail[0].role != "user":
+        tail.pop(0)
+
+    dropped = chat.history[:len(chat.history) - len(tail)]
+    snippets = "; ".join(
+        part.text[:80] for content in dropped for part in content.parts if part.text
+    )[:1000]
+    summary = [
+        {"role": "user", "parts": [f"(Summary of {len(dropped)} earlier messages: {snippets})"]},
+        {"role": "model", "parts": ["Understood, I'll keep that context in mind."]}
+    ]
+    return model.start_chat(history=summary + tail)
+
+async def _get_session(conversation_id: str):
+    """Fetch the cached chat session, hydrating it from the DB on first use"""
+    chat = SESSIONS.get(conversation_id)
+    if chat is None:
+        context = await get_conversation_context(conversation_id)
+        history = [
+            {"role": ROLE_MAP[role], "parts": [text]}
+            for role, text in context if role in ROLE_MAP
+        ]
+        chat = model.start_chat(history=history)
+        SESSION_TOKENS[conversation_id] = sum(est_tokens(text) for _, text in context)
+    if SESSION_TOKENS.get(conversation_id, 0) > HISTORY_TOKEN_BUDGET:
+        chat = _trimmed_session(chat)
+        SESSION_TOKENS[conversation_id] = sum(
+            est_tokens(part.text) for content in chat.history for part in content.parts
+        )
+    SESSIONS[conversation_id] = chat
+    return chat
+
+def sse(data: dict) -> dict:
+    """Build one SSE event for EventSourceResponse (orjson does the encoding)"""
+    return {"data": orjson.dumps(data).decode()}
+
+async def _generate_tokens(conversation_id: str, user_id: str, message: str):
+    """Yield plain response text chunks; persistence and events happen here
+    so both the SSE and non-streaming paths get them for free"""
     if model:
         try:
-            # Start chat with history
-            chat = model.start_chat(history=chat_history)
-            
-            # Generate streaming response
-            response = chat.send_message(message, stream=True)
-            
+            # Reuse the per-conversation session: only the new message is
+            # sent, the transcript prefix stays server-side in the session.
+            # Streaming via the async API keeps the event loop free between
+            # tokens instead of blocking on the sync iterator.
+            chat = await _get_session(conversation_id)
+            response = await chat.send_message_async(message, stream=True)
+
             full_response = ""
-            for chunk in response:
+            async for chunk in response:
                 if chunk.text:
                     full_response += chunk.text
-                    yield f"data: {json.dumps({'text': chunk.text})}\n\n"
-            
+                    yield chunk.text
+
+            # The session appended both turns itself - just bump the tally
+            SESSION_TOKENS[conversation_id] = (
+                SESSION_TOKENS.get(conversation_id, 0)
+                + est_tokens(message) + est_tokens(full_response)
+            )
+
             # Save assistant response
             save_message(conversation_id, user_id, full_response, "assistant")
-            
+
             # Publish event
             send_event("chat.message", {
                 "conversation_id": conversation_id,
@@ -222,20 +388,27 @@ Keep responses concise and engaging."""
                 "assistant_message": full_response,
                 "timestamp": datetime.now().isoformat()
             })
-            
-            yield f"data: {json.dumps({'done': True})}\n\n"
-            
+
         except Exception as e:
             print(f"Gemini API Error: {e}")
+            # The session's history may be half-appended - rebuild next turn
+            SESSIONS.pop(conversation_id, None)
+            SESSION_TOKENS.pop(conversation_id, None)
             error_msg = f"I apologize, but I encountered an error. Please try again. Error: {str(e)}"
-            yield f"data: {json.dumps({'text': error_msg, 'done': True})}\n\n"
+            yield error_msg
             save_message(conversation_id, user_id, error_msg, "assistant")
     else:
         # Fallback response if Gemini not configured
         fallback = "Chat service is not fully configured. Please add your GEMINI_API_KEY to the .env file."
-        yield f"data: {json.dumps({'text': fallback, 'done': True})}\n\n"
+        yield fallback
         save_message(conversation_id, user_id, fallback, "assistant")
 
+async def generate_streaming_response(conversation_id: str, user_id: str, message: str):
+    """SSE wrapper: JSON framing happens only at this edge"""
+    async for text in _generate_tokens(conversation_id, user_id, message):
+        yield sse({'text': text})
+    yield sse({'done': True})
+
 @app.post("/api/chat/message")
 async def send_message(request: ChatRequest):
     """
@@ -243,22 +416,21 @@ async def send_message(request: ChatRequest):
     """
     # Save user message
     save_message(request.conversation_id, request.user_id, request.message, "user")
-    
+
     if request.stream:
-        # Return streaming response
-        return StreamingResponse(
+        # EventSourceResponse handles the SSE framing and anti-buffering
+        # headers; periodic pings keep proxies from dropping idle streams
+        return EventSourceResponse(
             generate_streaming_response(request.conversation_id, request.user_id, request.message),
-            media_type="text/event-stream"
+            ping=15
         )
     else:
-        # Non-streaming response (for compatibility)
-        full_response = ""
-        async for chunk in generate_streaming_response(request.conversation_id, request.user_id, request.message):
-            if '"text"' in chunk:
-                data = json.loads(chunk.replace("data: ", ""))
-                if "text" in data:
-                    full_response += data["text"]
-        
+        # Non-streaming response (for compatibility) - accumulate the raw
+        # text, no JSON round-trip per token
+        full_response = "".join([
+            text async for text in _generate_tokens(request.conversation_id, request.user_id, request.message)
+        ])
+
         return {"response": full_response}
 
 # ===== New Conversation Management Endpoints =====
@@ -266,21 +438,13 @@ async def send_message(request: ChatRequest):
 @app.post("/api/chat/conversations/new")
 async def create_conversation(request: NewConversationRequest):
     """Create a new conversation"""
-    conn = get_db_connection()
-    if not conn:
+    if PG_POOL is None:
         raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO conversations (user_id, title) VALUES (%s, %s) RETURNING id, title, created_at",
-                (request.user_id, request.title)
-            )
-            result = cur.fetchone()
-        conn.commit()
-    finally:
-        conn.close()
-    
+    result = await PG_POOL.fetchrow(
+        "INSERT INTO conversations (user_id, title) VALUES ($1, $2) RETURNING id, title, created_at",
+        request.user_id, request.title
+    )
+
     return {
         "id": str(result[0]),
         "title": result[1],
@@ -290,28 +454,33 @@ async def create_conversation(request: NewConversationRequest):
 @app.get("/api/chat/conversations/list")
 async def list_user_conversations(user_id: str):
     """Get all conversations for a user with preview of last message"""
-    conn = get_db_connection()
-    if not conn:
+    if PG_POOL is None:
         raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT 
-                    c.id, 
-                    c.title, 
-                    c.updated_at,
-                    c.created_at,
-                    (SELECT message FROM chat_history WHERE conversation_id = c.id ORDER BY timestamp DESC LIMIT 1) as last_message,
-                    (SELECT COUNT(*) FROM chat_history WHERE conversation_id = c.id) as message_count
-                FROM conversations c
-                WHERE c.user_id = %s AND c.is_archived = FALSE
-                ORDER BY c.updated_at DESC
-            """, (user_id,))
-            rows = cur.fetchall()
-    finally:
-        conn.close()
-    
+    # Count and last message via per-conversation LATERAL probes on the
+    # (conversation_id, timestamp) index - scoped to this user's rows, so
+    # work scales with their conversations, not the whole table
+    rows = await PG_POOL.fetch("""
+        SELECT
+            c.id,
+            c.title,
+            c.updated_at,
+            c.created_at,
+            lm.message AS last_message,
+            cnt.n AS message_count
+        FROM conversations c
+        LEFT JOIN LATERAL (
+            SELECT COUNT(*) AS n FROM chat_history
+            WHERE conversation_id = c.id
+        ) cnt ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT message FROM chat_history
+            WHERE conversation_id = c.id
+            ORDER BY timestamp DESC LIMIT 1
+        ) lm ON TRUE
+        WHERE c.user_id = $1 AND c.is_archived = FALSE
+        ORDER BY c.updated_at DESC
+    """, user_id)
+
     return [{
         "id": str(row[0]),
         "title": row[1],
@@ -324,30 +493,23 @@ async def list_user_conversations(user_id: str):
 @app.get("/api/chat/conversations/{conversation_id}/messages")
 async def get_conversation_messages(conversation_id: str, limit: int = 100):
     """Get messages for a specific conversation"""
-    conn = get_db_connection()
-    if not conn:
+    if PG_POOL is None:
         raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
-        with conn.cursor() as cur:
-            # Get conversation info
-            cur.execute(
-                "SELECT title FROM conversations WHERE id = %s",
-                (conversation_id,)
-            )
-            conv = cur.fetchone()
-            if not conv:
-                raise HTTPException(status_code=404, detail="Conversation not found")
-            
-            # Get messages
-            cur.execute(
-                "SELECT id, message, role, timestamp FROM chat_history WHERE conversation_id = %s ORDER BY timestamp ASC LIMIT %s",
-                (conversation_id, limit)
-            )
-            rows = cur.fetchall()
-    finally:
-        conn.close()
-    
+    async with PG_POOL.acquire() as conn:
+        # Get conversation info
+        conv = await conn.fetchrow(
+            "SELECT title FROM conversations WHERE id = $1",
+            conversation_id
+        )
+        if not conv:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+
+        # Get messages
+        rows = await conn.fetch(
+            "SELECT id, message, role, timestamp FROM chat_history WHERE conversation_id = $1 ORDER BY timestamp ASC LIMIT $2",
+            conversation_id, limit
+        )
+
     return {
         "conversation_id": conversation_id,
         "title": conv[0],
@@ -362,39 +524,45 @@ async def get_conversation_messages(conversation_id: str, limit: int = 100):
 @app.patch("/api/chat/conversations/{conversation_id}/title")
 async def update_conversation_title(conversation_id: str, request: UpdateTitleRequest):
     """Update conversation title"""
-    conn = get_db_connection()
-    if not conn:
+    if PG_POOL is None:
         raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE conversations SET title = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-                (request.title, conversation_id)
-            )
-        conn.commit()
-    finally:
-        conn.close()
-    
+    await PG_POOL.execute(
+        "UPDATE conversations SET title = $1, updated_at = CURRENT_TIMESTAMP WHERE id = $2",
+        request.title, conversation_id
+    )
+
     return {"status": "updated", "title": request.title}
 
 @app.delete("/api/chat/conversations/{conversation_id}")
 async def delete_conversation(conversation_id: str):
     """Delete a specific conversation and all its messages"""
-    conn = get_db_connection()
-    if not conn:
+    if PG_POOL is None:
         raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
-        with conn.cursor() as cur:
-            # Delete conversation (messages will cascade delete due to foreign key)
-            cur.execute("DELETE FROM conversations WHERE id = %s", (conversation_id,))
-        conn.commit()
-    finally:
-        conn.close()
-    
+    # Delete conversation (messages will cascade delete due to foreign key)
+    await PG_POOL.execute("DELETE FROM conversations WHERE id = $1", conversation_id)
+
     return {"status": "deleted"}
 
+# Probes arrive every few seconds per replica - cache the DB ping so they
+# don't translate into constant Postgres traffic
+_DB_HEALTH = {"ok": False, "checked_at": 0.0}
+
+async def _db_healthy() -> bool:
+    """SELECT 1 on a pooled connection, cached for 5 seconds"""
+    now = time.monotonic()
+    if now - _DB_HEALTH["checked_at"] < 5:
+        return _DB_HEALTH["ok"]
+    ok = False
+    try:
+        if PG_POOL is not None:
+            await PG_POOL.fetchval("SELECT 1", timeout=0.5)
+            ok = True
+    except Exception as e:
+        print(f"Health check DB error: {e}")
+    _DB_HEALTH["ok"] = ok
+    _DB_HEALTH["checked_at"] = now
+    return ok
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -403,31 +571,53 @@ async def health_check():
         "status": "healthy",
         "service": "chat-service",
         "gemini_ai": gemini_status,
-        "database": "connected" if get_db_connection() else "disconnected"
+        "database": "connected" if await _db_healthy() else "disconnected"
     }
 
-def document_consumer():
+async def _consume_documents(consumer):
     """
-    Background worker: Listens for document processed events
+    Background task: Listens for document processed events
     to provide document-aware chat responses
     """
     try:
-        consumer = create_consumer("document.processed", "chat_service_group")
-        print("Kafka Consumer started: Listening for document events...")
-        
-        for message in consumer:
-            try:
-                data = message.value
-                doc_id = data.get('id')
-                content = data.get('content', '')
-                print(f"Received document event: {doc_id}")
-                # Store document context for future reference in chat
-                # This could be used to answer questions about uploaded documents
-            except Exception as e:
-                print(f"Error processing Kafka message: {e}")
+        # Pull batches and commit once per batch instead of per record
+        while True:
+            batches = await consumer.getmany(timeout_ms=500, max_records=100)
+            for tp, messages in batches.items():
+                for message in messages:
+                    try:
+                        data = message.value
+                        doc_id = data.get('id')
+                        content = data.get('content', '')
+                        print(f"Received document event: {doc_id}")
+                        # Store document context for future reference in chat
+                        # This could be used to answer questions about uploaded documents
+                    except Exception as e:
+                        print(f"Error processing Kafka message: {e}")
+            if batches:
+                await consumer.commit()
+    finally:
+        await consumer.stop()
+
+@app.on_event("startup")
+async def start_document_consumer():
+    """Consume document events on the event loop instead of a blocking thread"""
+    consumer = AIOKafkaConsumer(
+        "document.processed",
+        bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+        group_id="chat_service_group",
+        value_deserializer=lambda m: json.loads(m.decode('utf-8')),
+        auto_offset_reset='earliest',
+        enable_auto_commit=False
+    )
+    try:
+        await consumer.start()
     except Exception as e:
         print(f"Kafka consumer error: {e}")
+        return
+    print("Kafka Consumer started: Listening for document events...")
+    asyncio.create_task(_consume_documents(consumer))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -2,11 +2,19 @@ from kafka import KafkaConsumer
 import json
 from .config import KAFKA_BOOTSTRAP_SERVERS
 
-def create_consumer(topic, group_id):
-    return KafkaConsumer(
-        topic,
+def create_consumer(topic, group_id, **overrides):
+    """Create a consumer tuned for batched polling - the broker holds the
+    fetch briefly to fill a batch instead of answering one record at a
+    time. Callers can override any option (e.g. enable_auto_commit=False
+    to commit once per processed batch)."""
+    config = dict(
         bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
         group_id=group_id,
         value_deserializer=lambda m: json.loads(m.decode('utf-8')),
-        auto_offset_reset='earliest'
-    ) 
\ No newline at end of file
+        auto_offset_reset='earliest',
+        max_poll_records=100,
+        fetch_min_bytes=16384,
+        fetch_max_wait_ms=200,
+    )
+    config.update(overrides)
+    return KafkaConsumer(topic, **config)
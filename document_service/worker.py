@@ -0,0 +1,41 @@
+"""
+Standalone document processing worker.
+
+Consumes document.uploaded events and runs the same parse/notes pipeline
+the API would run in-process when Kafka is unavailable. Run one or more
+alongside the API pods to scale ingest independently:
+
+    python worker.py
+"""
+import sys
+
+sys.path.append("..")
+from common.kafka_consumer import create_consumer
+
+from main import process_document_async
+
+def run():
+    # Manual commits: offsets advance only after the batch is processed,
+    # so a crashed worker replays its in-flight documents
+    consumer = create_consumer(
+        "document.uploaded", "doc_workers",
+        enable_auto_commit=False, max_poll_records=50
+    )
+    print("Document worker started: listening for document.uploaded events...")
+    while True:
+        batch = consumer.poll(timeout_ms=500)
+        if not batch:
+            continue
+        for messages in batch.values():
+            for message in messages:
+                data = message.value
+                try:
+                    process_document_async(
+                        data["doc_id"], data["key"], data["filename"], data["file_type"]
+                    )
+                except Exception as e:
+                    print(f"Worker error processing {data.get('doc_id')}: {e}")
+        consumer.commit()
+
+if __name__ == "__main__":
+    run()
@@ -1,15 +1,27 @@
 import os
-import json
+import re
+import time
+import queue
+import logging
+import logging.handlers
+import orjson
 import uuid
+import asyncio
 import threading
 import boto3
+from botocore.config import Config as BotoConfig
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import psycopg2
+from psycopg2 import pool as pg_pool
+from contextlib import contextmanager
 from datetime import datetime
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 from dotenv import load_dotenv
 import google.generativeai as genai
+from cachetools import TTLCache
 import sys
 
 sys.path.append("..")
@@ -18,6 +30,43 @@ from common.kafka_producer import send_event
 
 load_dotenv()
 
+class _DedupFilter(logging.Filter):
+    """Drop log lines identical to one emitted within the last 5 seconds.
+
+    A broken Kafka broker or dead DB makes the retry loops repeat the
+    same error many times a second - one line per window is plenty.
+    """
+
+    def __init__(self, window: float = 5.0):
+        super().__init__()
+        self.window = window
+        self._last_seen = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        key = (record.levelno, record.getMessage())
+        last = self._last_seen.get(key)
+        if last is not None and now - last < self.window:
+            return False
+        if len(self._last_seen) > 256:
+            self._last_seen = {
+                k: t for k, t in self._last_seen.items() if now - t < self.window
+            }
+        self._last_seen[key] = now
+        return True
+
+# Records go onto an in-process queue and a single listener thread does
+# the actual stream writes - hot paths never block on a stdout flush
+_LOG_QUEUE = queue.SimpleQueue()
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, logging.StreamHandler())
+_LOG_LISTENER.start()
+
+logger = logging.getLogger("quiz_service")
+logger.setLevel(logging.INFO)
+_queue_handler = logging.handlers.QueueHandler(_LOG_QUEUE)
+_queue_handler.addFilter(_DedupFilter())
+logger.addHandler(_queue_handler)
+
 app = FastAPI(title="Quiz and Exercise Service", version="1.0.0")
 
 # --- Configuration ---
@@ -35,9 +84,22 @@ if GEMINI_API_KEY and GEMINI_API_KEY != "your_gemini_api_key_here":
     model = genai.GenerativeModel('gemini-2.0-flash')
 else:
     model = None
-    print("WARNING: GEMINI_API_KEY not configured. Quiz generation will be limited.")
+    logger.warning("GEMINI_API_KEY not configured. Quiz generation will be limited.")
 
-s3_client = boto3.client('s3', region_name=AWS_REGION)
+# Shared client with a widened connection pool - bursts of quiz persists
+# and deletes reuse sockets instead of queueing on the default 10-connection
+# pool; adaptive retries back off on S3 throttling
+s3_client = boto3.client('s3', region_name=AWS_REGION, config=BotoConfig(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+))
+
+# Scoring is pure CPU and holds the GIL - worker processes let concurrent
+# submissions grade in parallel across cores, the same arrangement the
+# document service uses for parsing. Arguments are plain lists of dicts,
+# so pickling is cheap.
+SCORE_EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count())
 
 # Pydantic models
 class QuizGenerationRequest(BaseModel):
@@ -54,21 +116,99 @@ class QuizSubmission(BaseModel):
     user_id: str
     answers: List[QuizAnswer]
 
-def get_db_connection():
+# Hot statements, prepared once per pooled connection so Postgres skips
+# parse+plan on every request - same pattern as the auth service.
+# Endpoints run EXECUTE <name>(...) instead of re-sending the SQL text.
+# Only quiz-owned tables appear here: PREPARE validates at connect time,
+# and the documents table belongs to the document service.
+PREPARED_STATEMENTS = {
+    "quiz_insert": """
+        INSERT INTO quizzes (id, document_id, title, questions)
+        VALUES ($1, $2, $3, $4::jsonb)
+    """,
+    "quiz_questions": """
+        SELECT questions FROM quizzes WHERE id = $1
+    """,
+    "quiz_public": """
+        SELECT q.id, q.title,
+               (SELECT jsonb_agg(elem - 'correct_answer' - 'explanation' ORDER BY ord)
+                FROM jsonb_array_elements(q.questions) WITH ORDINALITY AS t(elem, ord)),
+               q.created_at
+        FROM quizzes q WHERE q.id = $1
+    """,
+    "quiz_history": """
+        SELECT qr.quiz_id, q.title, qr.score, qr.submitted_at
+        FROM quiz_responses qr
+        JOIN quizzes q ON qr.quiz_id = q.id
+        WHERE qr.user_id = $1
+          AND ($2::timestamp IS NULL OR qr.submitted_at < $2)
+        ORDER BY qr.submitted_at DESC LIMIT $3
+    """,
+    "response_insert": """
+        INSERT INTO quiz_responses (quiz_id, user_id, answers, score, feedback)
+        VALUES ($1, $2, $3::jsonb, $4, $5::jsonb)
+    """,
+    "latest_result": """
+        SELECT score, feedback, submitted_at FROM quiz_responses
+        WHERE quiz_id = $1 AND user_id = $2
+        ORDER BY submitted_at DESC LIMIT 1
+    """,
+}
+
+class PreparedConnectionPool(pg_pool.ThreadedConnectionPool):
+    """Connection pool that prepares the hot statements on every new connection"""
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        with conn.cursor() as cursor:
+            for name, sql in PREPARED_STATEMENTS.items():
+                cursor.execute(f"PREPARE {name} AS {sql}")
+        conn.commit()
+        return conn
+
+# Connection pool - avoids a fresh TCP+TLS+auth handshake per request.
+# Created lazily so the service still starts when the DB is down, and so
+# initialize_database has created the tables the PREPAREs reference.
+DB_POOL = None
+
+def _get_pool():
+    global DB_POOL
+    if DB_POOL is None:
+        try:
+            DB_POOL = PreparedConnectionPool(
+                minconn=2, maxconn=20,
+                host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS
+            )
+        except psycopg2.Error as e:
+            logger.error(f"Database pool creation failed: {e}")
+    return DB_POOL
+
+@contextmanager
+def db_conn():
+    """Borrow a pooled connection; yields None if the database is unavailable"""
+    conn_pool = _get_pool()
+    if conn_pool is None:
+        yield None
+        return
+    conn = conn_pool.getconn()
     try:
-        return psycopg2.connect(
-            host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS
-        )
-    except psycopg2.Error as e:
-        print(f"Database connection failed: {e}")
-        return None
+        yield conn
+    finally:
+        conn_pool.putconn(conn)
 
 @app.on_event("startup")
 def initialize_database():
-    conn = get_db_connection()
-    if not conn:
-        return
+    # Direct connection for DDL: the pool's PREPAREs reference these
+    # tables, so the schema has to exist before the first pooled
+    # connection is made
     try:
+        conn = psycopg2.connect(
+            host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS
+        )
+    except psycopg2.Error as e:
+        logger.error(f"Database initialization failed: {e}")
+        conn = None
+    if conn:
         with conn.cursor() as cur:
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS quizzes (
@@ -88,44 +228,38 @@ def initialize_database():
                     submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
                 CREATE INDEX IF NOT EXISTS idx_quiz_doc ON quizzes(document_id);
-                CREATE INDEX IF NOT EXISTS idx_response_user ON quiz_responses(user_id);
+                -- Covering index: history is an index-only scan in
+                -- submitted order, no sort and no heap fetches. Replaces
+                -- the plain idx_response_user, whose prefix it includes.
+                CREATE INDEX IF NOT EXISTS idx_response_user_submitted
+                    ON quiz_responses(user_id, submitted_at DESC)
+                    INCLUDE (quiz_id, score);
+                DROP INDEX IF EXISTS idx_response_user;
             """)
-            conn.commit()
-    finally:
+        conn.commit()
         conn.close()
     # Start Kafka consumer
     threading.Thread(target=document_notes_consumer, daemon=True).start()
 
-def generate_quiz_with_ai(document_content: str, document_title: str, num_questions: int = 5, question_types: List[str] = None):
-    """Generate quiz questions using Gemini AI"""
-    if not model:
-        return {
-            "questions": [
-                {
-                    "id": 1,
-                    "type": "multiple_choice",
-                    "question": "AI not configured. Please add GEMINI_API_KEY.",
-                    "options": ["A", "B", "C", "D"],
-                    "correct_answer": "A",
-                    "explanation": "Configuration required"
-                }
-            ]
-        }
-    
-    if not question_types:
-        question_types = ["multiple_choice", "true_false"]
-    
-    try:
-        prompt = f"""You are an expert quiz generator. Create {num_questions} educational quiz questions based on the following document.
+# Matches the markdown code fences Gemini wraps around JSON
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$', re.S)
+
+def _strip_fences(text: str) -> str:
+    """Remove markdown code fences Gemini wraps around JSON"""
+    return _FENCE_RE.sub('', text).strip()
+
+# Static prompt scaffolding built once at import - per call only the
+# variable slots are formatted in
+QUIZ_PROMPT_TMPL = """You are an expert quiz generator. Create {num_questions} educational quiz questions based on the following document.
 
-Document Title: {document_title}
+Document Title: {title}
 
 Document Content:
-{document_content[:10000]}
+{content}
 
 Requirements:
 - Generate exactly {num_questions} questions
-- Include these question types: {', '.join(question_types)}
+- Include these question types: {types}
 - Each question should test understanding of key concepts
 - Provide detailed explanations for correct answers
 - Make the quiz challenging but fair
@@ -146,40 +280,76 @@ Format your response as a JSON array of questions with this structure:
 
 IMPORTANT: Return ONLY valid JSON, no additional text."""
 
-        response = model.generate_content(prompt)
-        
+# A handful of type combinations recur constantly - memoize the join
+_TYPES_JOIN_CACHE = {}
+
+def _join_types(question_types: List[str]) -> str:
+    key = tuple(question_types)
+    joined = _TYPES_JOIN_CACHE.get(key)
+    if joined is None:
+        joined = ', '.join(question_types)
+        _TYPES_JOIN_CACHE[key] = joined
+    return joined
+
+def generate_quiz_with_ai(document_content: str, document_title: str, num_questions: int = 5, question_types: List[str] = None):
+    """Generate quiz questions using Gemini AI"""
+    if not model:
+        # "fallback" marks placeholder quizzes so callers neither cache
+        # nor persist them - popped before anything reaches the client
+        return {
+            "fallback": True,
+            "questions": [
+                {
+                    "id": 1,
+                    "type": "multiple_choice",
+                    "question": "AI not configured. Please add GEMINI_API_KEY.",
+                    "options": ["A", "B", "C", "D"],
+                    "correct_answer": "A",
+                    "explanation": "Configuration required"
+                }
+            ]
+        }
+    
+    if not question_types:
+        question_types = ["multiple_choice", "true_false"]
+    
+    try:
+        prompt = QUIZ_PROMPT_TMPL.format(
+            num_questions=num_questions,
+            title=document_title,
+            content=document_content,
+            types=_join_types(question_types)
+        )
+
+        # Stream the response so transfer overlaps generation instead of
+        # waiting for the last token before any bytes move
+        response = model.generate_content(prompt, stream=True)
+        raw = "".join(chunk.text for chunk in response if chunk.text)
+
         # Try to parse JSON
         try:
-            # Remove markdown code blocks if present
-            text = response.text.strip()
-            if text.startswith("```json"):
-                text = text[7:]
-            if text.startswith("```"):
-                text = text[3:]
-            if text.endswith("```"):
-                text = text[:-3]
-            text = text.strip()
-            
-            quiz_data = json.loads(text)
+            quiz_data = orjson.loads(_strip_fences(raw))
             return quiz_data
-        except json.JSONDecodeError as e:
-            print(f"JSON parse error: {e}, Response: {response.text[:200]}")
+        except orjson.JSONDecodeError as e:
+            logger.warning(f"JSON parse error: {e}, Response: {raw[:200]}")
             # Fallback: create basic quiz from response
             return {
+                "fallback": True,
                 "questions": [
                     {
                         "id": 1,
                         "type": "short_answer",
                         "question": "What are the key concepts from this document?",
                         "correct_answer": "See document content",
-                        "explanation": response.text[:500]
+                        "explanation": raw[:500]
                     }
                 ]
             }
     
     except Exception as e:
-        print(f"Quiz generation error: {e}")
+        logger.error(f"Quiz generation error: {e}")
         return {
+            "fallback": True,
             "questions": [
                 {
                     "id": 1,
@@ -195,32 +365,38 @@ IMPORTANT: Return ONLY valid JSON, no additional text."""
 def calculate_score_and_feedback(quiz_questions: List[Dict], user_answers: List[Dict]):
     """Calculate score and provide detailed feedback"""
     total_questions = len(quiz_questions)
-    correct_count = 0
-    feedback = []
-    
+    if total_questions == 0:
+        return {"score": 0, "correct_count": 0, "total_questions": 0, "feedback": []}
+
     # Create answer lookup
     answer_map = {ans["question_id"]: ans["answer"] for ans in user_answers}
-    
-    for question in quiz_questions:
-        q_id = question["id"]
-        correct_answer = question["correct_answer"].lower().strip()
-        user_answer = answer_map.get(q_id, "").lower().strip()
-        
-        is_correct = user_answer == correct_answer
-        if is_correct:
-            correct_count += 1
-        
-        feedback.append({
-            "question_id": q_id,
+
+    # Normalize and compare in C - one pass of lower/strip per array
+    # instead of per-question Python string calls
+    correct = np.char.strip(np.char.lower(
+        np.array([q["correct_answer"] for q in quiz_questions], dtype=str)
+    ))
+    user = np.char.strip(np.char.lower(
+        np.array([answer_map.get(q["id"], "") for q in quiz_questions], dtype=str)
+    ))
+    mask = user == correct
+    correct_count = int(mask.sum())
+
+    feedback = [
+        {
+            "question_id": question["id"],
             "question": question["question"],
             "user_answer": user_answer,
             "correct_answer": correct_answer,
             "is_correct": is_correct,
             "explanation": question.get("explanation", "")
-        })
-    
-    score = (correct_count / total_questions) * 100 if total_questions > 0 else 0
-    
+        }
+        for question, user_answer, correct_answer, is_correct
+        in zip(quiz_questions, user.tolist(), correct.tolist(), mask.tolist())
+    ]
+
+    score = (correct_count / total_questions) * 100
+
     return {
         "score": round(score, 2),
         "correct_count": correct_count,
@@ -228,108 +404,281 @@ def calculate_score_and_feedback(quiz_questions: List[Dict], user_answers: List[
         "feedback": feedback
     }
 
-@app.post("/api/quiz/generate")
-async def generate_quiz(request: QuizGenerationRequest, background_tasks: BackgroundTasks):
-    """Generate a quiz from a document"""
-    # Get document content from database
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
-        with conn.cursor() as cur:
-            # Try to get document content from document service database
-            cur.execute(
-                "SELECT filename, content_preview FROM documents WHERE id = %s",
-                (request.document_id,)
+class QuizBatchWorker:
+    """Coalesces concurrent quiz generations into one Gemini call.
+
+    Requests arriving within the flush window share a single prompt that
+    asks for one quiz per document; each caller awaits a future resolved
+    with its own quiz. A batch of one takes the plain single-request
+    path, so solo callers pay no extra latency beyond the window.
+    """
+
+    def __init__(self, flush_interval: float = 0.1, max_batch: int = 8):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        asyncio.create_task(self._run())
+
+    async def generate(self, content, title, num_questions, question_types):
+        if self.queue is None or model is None:
+            return await asyncio.to_thread(
+                generate_quiz_with_ai, content, title, num_questions, question_types
             )
-            doc = cur.fetchone()
-            
-            if not doc:
-                raise HTTPException(status_code=404, detail="Document not found")
-            
-            filename = doc[0]
-            content = doc[1] or "No content available"
-            
-            # Also try to get notes for richer content
-            cur.execute(
-                "SELECT notes, summary FROM document_notes WHERE document_id = %s ORDER BY created_at DESC LIMIT 1",
-                (request.document_id,)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((content, title, num_questions, question_types, future))
+        return await future
+
+    @staticmethod
+    def _resolve(future, result):
+        # A dropped client cancels its request task and with it the
+        # future - setting a result then would raise InvalidStateError
+        if not future.done():
+            future.set_result(result)
+
+    async def _run(self):
+        # The worker is the only queue drainer: if this task dies every
+        # later generate() awaits forever, so nothing may escape the loop
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                await asyncio.sleep(self.flush_interval)
+                while not self.queue.empty() and len(batch) < self.max_batch:
+                    batch.append(self.queue.get_nowait())
+
+                if len(batch) == 1:
+                    content, title, num_questions, question_types, future = batch[0]
+                    result = await asyncio.to_thread(
+                        generate_quiz_with_ai, content, title, num_questions, question_types
+                    )
+                    self._resolve(future, result)
+                    continue
+
+                try:
+                    results = await asyncio.to_thread(self._generate_batch, batch)
+                    for (_, _, _, _, future), result in zip(batch, results):
+                        self._resolve(future, result)
+                except Exception as e:
+                    logger.warning(f"Batched quiz generation failed ({e}), falling back to single calls")
+                    for content, title, num_questions, question_types, future in batch:
+                        result = await asyncio.to_thread(
+                            generate_quiz_with_ai, content, title, num_questions, question_types
+                        )
+                        self._resolve(future, result)
+            except Exception as e:
+                logger.error(f"Quiz batch worker error: {e}")
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(
+                            HTTPException(status_code=500, detail="Quiz generation failed")
+                        )
+
+    def _generate_batch(self, batch):
+        # Split the shared content budget so the combined prompt stays
+        # roughly the size of a single-document one
+        per_doc_budget = 10000 // len(batch)
+        sections = []
+        for i, (content, title, num_questions, question_types, _) in enumerate(batch):
+            types = ', '.join(question_types or ["multiple_choice", "true_false"])
+            sections.append(
+                f"Document {i + 1} Title: {title}\n"
+                f"Questions required: {num_questions}\n"
+                f"Question types: {types}\n"
+                f"Content:\n{content[:per_doc_budget]}"
             )
-            notes_row = cur.fetchone()
-            
-            if notes_row:
-                content = f"Summary: {notes_row[1]}\n\nNotes: {notes_row[0]}\n\nFull Content: {content}"
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-    finally:
-        conn.close()
-    
-    # Generate quiz with AI
-    quiz_data = generate_quiz_with_ai(
-        content,
-        filename,
-        request.num_questions,
-        request.question_types
-    )
-    
-    # Save quiz to database
-    quiz_id = str(uuid.uuid4())
-    conn = get_db_connection()
-    if conn:
+
+        prompt = f"""You are an expert quiz generator. Create one quiz per document below ({len(batch)} documents total).
+
+{chr(10).join(sections)}
+
+For each document generate exactly the number of questions requested, using the listed question types. Each question needs "id", "type", "question", "options" (multiple choice only), "correct_answer" and "explanation" fields.
+
+Format your response as a JSON array with exactly {len(batch)} objects, one per document in order, each shaped as {{"questions": [...]}}.
+
+IMPORTANT: Return ONLY valid JSON, no additional text."""
+
+        response = model.generate_content(prompt)
+        results = orjson.loads(_strip_fences(response.text))
+        if not isinstance(results, list) or len(results) != len(batch):
+            raise ValueError(f"expected {len(batch)} quizzes, got {type(results).__name__}")
+        return results
+
+QUIZ_BATCHER = QuizBatchWorker()
+
+# Generated quizzes keyed by (document_id, num_questions, sorted types) -
+# classroom "regenerate" clicks repeat identical inputs, and a dict hit is
+# ~1000x cheaper than a Gemini call. Lock guards access from the Kafka
+# consumer thread. Entries are dropped when new notes arrive for a document.
+QUIZ_CACHE = TTLCache(maxsize=1024, ttl=3600)
+QUIZ_CACHE_LOCK = threading.Lock()
+
+def _quiz_cache_key(request: QuizGenerationRequest):
+    return (request.document_id, request.num_questions, tuple(sorted(request.question_types)))
+
+@app.on_event("startup")
+async def start_quiz_batcher():
+    # The Kafka consumer thread schedules pre-warm coroutines onto this loop
+    app.state.loop = asyncio.get_running_loop()
+    QUIZ_BATCHER.start()
+
+def est_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars/token for English prose)"""
+    return len(text) // 4
+
+# Context budget for quiz prompts - ~10 kB of text
+QUIZ_CONTEXT_TOKENS = 2500
+
+def _truncate_sentences(text: str, max_chars: int) -> str:
+    """Cut at the last sentence boundary before max_chars, never mid-word"""
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind('. ', 0, max_chars)
+    if cut == -1:
+        cut = text.rfind(' ', 0, max_chars)
+    return text[:cut + 1] if cut > 0 else text[:max_chars]
+
+def pick_context(content: str, notes: str = None, summary: str = None,
+                 max_tokens: int = QUIZ_CONTEXT_TOKENS) -> str:
+    """Select the densest document context that fits the token budget.
+
+    Generated notes and summary already distil the document, so when they
+    exist they replace the raw text outright instead of being prepended
+    to it - the old concatenation tripled the prompt for no quality gain.
+    Whatever is chosen is trimmed at a sentence boundary.
+    """
+    if notes or summary:
+        parts = []
+        if summary:
+            parts.append(f"Summary: {summary}")
+        if notes:
+            parts.append(f"Notes: {notes}")
+        context = "\n\n".join(parts)
+    else:
+        context = content or "No content available"
+    if est_tokens(context) <= max_tokens:
+        return context
+    return _truncate_sentences(context, max_tokens * 4)
+
+def _fetch_document_content(document_id: str):
+    """Blocking document lookup - called via asyncio.to_thread"""
+    with db_conn() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database unavailable")
         try:
+            with conn.cursor() as cur:
+                # One round trip for document plus latest notes - the
+                # lateral subquery picks the newest document_notes row per
+                # document using the index on document_id
+                cur.execute(
+                    """SELECT d.filename, d.content_preview, n.notes, n.summary
+                       FROM documents d
+                       LEFT JOIN LATERAL (
+                           SELECT notes, summary FROM document_notes
+                           WHERE document_id = d.id
+                           ORDER BY created_at DESC LIMIT 1
+                       ) n ON true
+                       WHERE d.id = %s""",
+                    (document_id,)
+                )
+                doc = cur.fetchone()
+
+                if not doc:
+                    raise HTTPException(status_code=404, detail="Document not found")
+
+                filename = doc[0]
+                content = pick_context(doc[1], notes=doc[2], summary=doc[3])
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return filename, content
+
+def _persist_quiz(quiz_id: str, document_id: str, filename: str, quiz_data: dict):
+    """Blocking quiz persistence: DB insert, S3 copy, Kafka event"""
+    with db_conn() as conn:
+        if conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    """INSERT INTO quizzes (id, document_id, title, questions) 
-                       VALUES (%s, %s, %s, %s)""",
-                    (quiz_id, request.document_id, f"Quiz: {filename}", json.dumps(quiz_data["questions"]))
+                    "EXECUTE quiz_insert (%s, %s, %s, %s)",
+                    (quiz_id, document_id, f"Quiz: {filename}", orjson.dumps(quiz_data["questions"]).decode())
                 )
             conn.commit()
-        finally:
-            conn.close()
-    
-    # Save to S3
-    s3_key = f"quizzes/{quiz_id}.json"
+
     s3_client.put_object(
         Bucket=S3_BUCKET,
-        Key=s3_key,
-        Body=json.dumps(quiz_data),
+        Key=f"quizzes/{quiz_id}.json",
+        Body=orjson.dumps(quiz_data),
         ContentType='application/json'
     )
-    
-    # Publish event
+
     send_event("quiz.generated", {
         "quiz_id": quiz_id,
-        "document_id": request.document_id,
+        "document_id": document_id,
         "num_questions": len(quiz_data["questions"]),
         "timestamp": datetime.now().isoformat()
     })
-    
-    return {
+
+@app.post("/api/quiz/generate")
+async def generate_quiz(request: QuizGenerationRequest, background_tasks: BackgroundTasks):
+    """Generate a quiz from a document"""
+    # Identical parameters within the TTL reuse the stored quiz outright
+    cache_key = _quiz_cache_key(request)
+    with QUIZ_CACHE_LOCK:
+        cached = QUIZ_CACHE.get(cache_key)
+    if cached:
+        return cached
+
+    # Blocking DB/Gemini/S3 work runs on worker threads so the long
+    # generation call doesn't stall every other request on the loop
+    filename, content = await asyncio.to_thread(_fetch_document_content, request.document_id)
+
+    quiz_data = await QUIZ_BATCHER.generate(
+        content,
+        filename,
+        request.num_questions,
+        request.question_types
+    )
+
+    # A placeholder produced on Gemini failure must not be persisted or
+    # cached - a transient error would otherwise be served for the whole
+    # cache TTL. Surface it as a retryable upstream error instead.
+    if quiz_data.pop("fallback", False):
+        raise HTTPException(status_code=503, detail="Quiz generation temporarily unavailable")
+
+    # Persist after the response is sent - the client gets the quiz as
+    # soon as Gemini finishes instead of waiting on DB + S3 + Kafka.
+    # BackgroundTasks runs the sync helper on a worker thread.
+    quiz_id = str(uuid.uuid4())
+    background_tasks.add_task(_persist_quiz, quiz_id, request.document_id, filename, quiz_data)
+
+    result = {
         "quiz_id": quiz_id,
         "title": f"Quiz: {filename}",
         "num_questions": len(quiz_data["questions"]),
         "status": "generated"
     }
+    with QUIZ_CACHE_LOCK:
+        QUIZ_CACHE[cache_key] = result
+    return result
 
 @app.get("/api/quiz/history")
-async def get_quiz_history(user_id: str, limit: int = 20):
-    """Get quiz history for a user"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
+def get_quiz_history(user_id: str, limit: int = 20, cursor: Optional[datetime] = None):
+    """Get quiz history for a user.
+
+    Pass the last row's submitted_at as `cursor` to fetch the next page -
+    keyset pagination stays O(limit) however many responses a user has,
+    where OFFSET would rescan everything skipped. The response stays a
+    plain array; the client derives the cursor from the final row.
+    """
+    with db_conn() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database unavailable")
         with conn.cursor() as cur:
-            cur.execute(
-                """SELECT qr.quiz_id, q.title, qr.score, qr.submitted_at 
-                   FROM quiz_responses qr
-                   JOIN quizzes q ON qr.quiz_id = q.id
-                   WHERE qr.user_id = %s 
-                   ORDER BY qr.submitted_at DESC LIMIT %s""",
-                (user_id, limit)
-            )
+            cur.execute("EXECUTE quiz_history (%s, %s, %s)", (user_id, cursor, limit))
             history = [
                 {
                     "quiz_id": row[0],
@@ -339,166 +688,234 @@ async def get_quiz_history(user_id: str, limit: int = 20):
                 }
                 for row in cur.fetchall()
             ]
-    finally:
-        conn.close()
-    
+
     return history  # Return empty array if no results
 
 @app.get("/api/quiz/{id}")
-async def get_quiz(id: str):
+def get_quiz(id: str):
     """Get quiz questions"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
+    with db_conn() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database unavailable")
         with conn.cursor() as cur:
-            cur.execute(
-                "SELECT id, title, questions, created_at FROM quizzes WHERE id = %s",
-                (id,)
-            )
+            # quiz_public strips answers and explanations inside Postgres -
+            # the sensitive fields never cross the wire and Python builds
+            # no throwaway dicts
+            cur.execute("EXECUTE quiz_public (%s)", (id,))
             quiz = cur.fetchone()
-    finally:
-        conn.close()
-    
+
     if not quiz:
         raise HTTPException(status_code=404, detail="Quiz not found")
-    
-    # Parse questions - JSONB is already parsed by psycopg2
-    questions = quiz[2] if isinstance(quiz[2], list) else json.loads(quiz[2])
-    hidden_questions = [
-        {k: v for k, v in q.items() if k not in ["correct_answer", "explanation"]}
-        for q in questions
-    ]
-    
+
     return {
         "id": quiz[0],
         "title": quiz[1],
-        "questions": hidden_questions,
+        "questions": quiz[2] or [],
         "created_at": quiz[3].isoformat() if quiz[3] else None
     }
 
-@app.post("/api/quiz/{id}/submit")
-async def submit_quiz(id: str, submission: QuizSubmission):
-    """Submit quiz answers and get results"""
-    # Get quiz questions
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
+def _fetch_quiz_questions(quiz_id: str):
+    """Blocking quiz lookup - called via asyncio.to_thread"""
+    with db_conn() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database unavailable")
         with conn.cursor() as cur:
-            cur.execute("SELECT questions FROM quizzes WHERE id = %s", (id,))
+            cur.execute("EXECUTE quiz_questions (%s)", (quiz_id,))
             quiz = cur.fetchone()
-            
-            if not quiz:
-                raise HTTPException(status_code=404, detail="Quiz not found")
-            
-            # JSONB is already parsed by psycopg2
-            questions = quiz[0] if isinstance(quiz[0], list) else json.loads(quiz[0])
-    
-        # Calculate score and feedback
-        results = calculate_score_and_feedback(
-            questions,
-            [ans.dict() for ans in submission.answers]
-        )
-        
-        # Save response
+
+    if not quiz:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+
+    # JSONB is already parsed by psycopg2
+    return quiz[0] if isinstance(quiz[0], list) else orjson.loads(quiz[0])
+
+def _store_response(quiz_id: str, user_id: str, answers: list, results: dict):
+    """Blocking response insert - called via asyncio.to_thread"""
+    with db_conn() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database unavailable")
         with conn.cursor() as cur:
             cur.execute(
-                """INSERT INTO quiz_responses (quiz_id, user_id, answers, score, feedback) 
-                   VALUES (%s, %s, %s, %s, %s)""",
-                (id, submission.user_id, json.dumps([ans.dict() for ans in submission.answers]),
-                 results["score"], json.dumps(results["feedback"]))
+                "EXECUTE response_insert (%s, %s, %s, %s, %s)",
+                (quiz_id, user_id, orjson.dumps(answers).decode(),
+                 results["score"], orjson.dumps(results["feedback"]).decode())
             )
         conn.commit()
-        
-    finally:
-        conn.close()
-    
+
+@app.post("/api/quiz/{id}/submit")
+async def submit_quiz(id: str, submission: QuizSubmission):
+    """Submit quiz answers and get results"""
+    questions = await asyncio.to_thread(_fetch_quiz_questions, id)
+
+    # One dump of the answers feeds scoring and the DB insert alike
+    answers = [ans.model_dump() for ans in submission.answers]
+    results = await asyncio.get_running_loop().run_in_executor(
+        SCORE_EXECUTOR, calculate_score_and_feedback, questions, answers
+    )
+
+    # Save response
+    await asyncio.to_thread(_store_response, id, submission.user_id, answers, results)
+
     return results
 
 @app.get("/api/quiz/{id}/results")
-async def get_quiz_results(id: str, user_id: str):
+def get_quiz_results(id: str, user_id: str):
     """Get quiz results for a specific user"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
+    with db_conn() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database unavailable")
         with conn.cursor() as cur:
-            cur.execute(
-                """SELECT score, feedback, submitted_at FROM quiz_responses 
-                   WHERE quiz_id = %s AND user_id = %s ORDER BY submitted_at DESC LIMIT 1""",
-                (id, user_id)
-            )
+            cur.execute("EXECUTE latest_result (%s, %s)", (id, user_id))
             result = cur.fetchone()
-    finally:
-        conn.close()
-    
+
     if not result:
         raise HTTPException(status_code=404, detail="No results found")
     
     return {
         "score": result[0],
-        "feedback": json.loads(result[1]),
+        "feedback": result[1] if isinstance(result[1], list) else orjson.loads(result[1]),
         "submitted_at": result[2].isoformat() if result[2] else None
     }
 
 
 
+# Registered before /api/quiz/{id} so the literal path wins the match
+@app.delete("/api/quiz/cache")
+def clear_quiz_cache():
+    """Admin hook: drop all cached quiz generations"""
+    with QUIZ_CACHE_LOCK:
+        QUIZ_CACHE.clear()
+    return {"status": "cleared"}
+
+def _delete_s3_object(key: str, attempts: int = 3):
+    """Best-effort S3 cleanup with backoff - runs after the response is sent"""
+    for attempt in range(attempts):
+        try:
+            s3_client.delete_object(Bucket=S3_BUCKET, Key=key)
+            return
+        except Exception as e:
+            if attempt == attempts - 1:
+                logger.error(f"S3 deletion error for {key}: {e}")
+            else:
+                time.sleep(2 ** attempt)
+
 @app.delete("/api/quiz/{id}")
-async def delete_quiz(id: str):
+def delete_quiz(id: str, background_tasks: BackgroundTasks):
     """Delete a quiz"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="Database unavailable")
-    
-    try:
+    with db_conn() as conn:
+        if not conn:
+            raise HTTPException(status_code=500, detail="Database unavailable")
         with conn.cursor() as cur:
             cur.execute("DELETE FROM quizzes WHERE id = %s", (id,))
         conn.commit()
-        
-        # Delete from S3
-        try:
-            s3_client.delete_object(Bucket=S3_BUCKET, Key=f"quizzes/{id}.json")
-        except Exception as e:
-            print(f"S3 deletion error: {e}")
-    finally:
-        conn.close()
-    
+
+    # The quiz is gone once the DB row is deleted - S3 cleanup can happen
+    # after the response, with retries for transient failures
+    background_tasks.add_task(_delete_s3_object, f"quizzes/{id}.json")
+
     return {"status": "deleted"}
 
+# Probes arrive every few seconds per replica - cache the DB ping so they
+# don't translate into constant Postgres traffic
+_DB_HEALTH = {"ok": False, "checked_at": 0.0}
+
+def _db_healthy() -> bool:
+    """SELECT 1 on a pooled connection, cached for 5 seconds"""
+    now = time.monotonic()
+    if now - _DB_HEALTH["checked_at"] < 5:
+        return _DB_HEALTH["ok"]
+    ok = False
+    try:
+        with db_conn() as conn:
+            if conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                    cur.fetchone()
+                ok = True
+    except Exception as e:
+        logger.error(f"Health check DB error: {e}")
+    _DB_HEALTH["ok"] = ok
+    _DB_HEALTH["checked_at"] = now
+    return ok
+
 @app.get("/health")
-async def health_check():
+def health_check():
     """Health check endpoint"""
     gemini_status = "configured" if model else "not_configured"
     return {
         "status": "healthy",
         "service": "quiz-service",
         "gemini_ai": gemini_status,
-        "database": "connected" if get_db_connection() else "disconnected"
+        "database": "connected" if _db_healthy() else "disconnected"
     }
 
+async def _prewarm_quiz(doc_id: str):
+    """Generate and cache a default-parameter quiz ahead of the first request.
+
+    Runs the same path as /api/quiz/generate - fetch content, batched
+    Gemini call, persist - so a later request with default parameters is
+    a pure cache hit.
+    """
+    request = QuizGenerationRequest(document_id=doc_id)
+    cache_key = _quiz_cache_key(request)
+    with QUIZ_CACHE_LOCK:
+        if cache_key in QUIZ_CACHE:
+            return
+
+    try:
+        filename, content = await asyncio.to_thread(_fetch_document_content, doc_id)
+        quiz_data = await QUIZ_BATCHER.generate(
+            content, filename, request.num_questions, request.question_types
+        )
+        if quiz_data.pop("fallback", False):
+            logger.warning(f"Quiz pre-warm for document {doc_id} got a fallback quiz, not caching")
+            return
+        quiz_id = str(uuid.uuid4())
+        await asyncio.to_thread(_persist_quiz, quiz_id, doc_id, filename, quiz_data)
+        with QUIZ_CACHE_LOCK:
+            QUIZ_CACHE[cache_key] = {
+                "quiz_id": quiz_id,
+                "title": f"Quiz: {filename}",
+                "num_questions": len(quiz_data["questions"]),
+                "status": "generated"
+            }
+        logger.info(f"Pre-warmed quiz {quiz_id} for document {doc_id}")
+    except Exception as e:
+        logger.error(f"Quiz pre-warm failed for document {doc_id}: {e}")
+
 def document_notes_consumer():
     """
-    Background worker: Listens for document notes generated events
-    to automatically suggest quiz generation
+    Background worker: Listens for document notes generated events,
+    invalidates stale cached quizzes and pre-warms replacements
     """
     try:
         consumer = create_consumer("notes.generated", "quiz_service_group")
-        print("Kafka Consumer started: Listening for document notes...")
-        
-        for message in consumer:
-            try:
-                data = message.value
-                doc_id = data.get('document_id')
-                print(f"Received notes for document: {doc_id}")
-                # Could auto-generate quiz here if desired
-            except Exception as e:
-                print(f"Error processing Kafka message: {e}")
+        logger.info("Kafka Consumer started: Listening for document notes...")
+
+        while True:
+            batch = consumer.poll(timeout_ms=500, max_records=32)
+            if not batch:
+                continue
+            for messages in batch.values():
+                for message in messages:
+                    try:
+                        data = message.value
+                        doc_id = data.get('document_id')
+                        logger.info(f"Received notes for document: {doc_id}")
+                        # New notes change the generation input - drop any
+                        # cached quizzes for this document
+                        with QUIZ_CACHE_LOCK:
+                            for key in [k for k in QUIZ_CACHE.keys() if k[0] == doc_id]:
+                                QUIZ_CACHE.pop(key, None)
+                        # Regenerate off the user path: the first request
+                        # after new notes lands on a warm cache
+                        loop = getattr(app.state, "loop", None)
+                        if doc_id and loop is not None:
+                            asyncio.run_coroutine_threadsafe(_prewarm_quiz(doc_id), loop)
+                    except Exception as e:
+                        logger.error(f"Error processing Kafka message: {e}")
     except Exception as e:
-        print(f"Kafka consumer error: {e}")
+        logger.error(f"Kafka consumer error: {e}")
 
 if __name__ == "__main__":
     import uvicorn